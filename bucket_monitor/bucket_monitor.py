@@ -30,14 +30,25 @@ from __future__ import print_function
 
 import os
 import re
-import uuid
 import datetime
 import logging
+import threading
 
-import pytz
+from google.api_core import exceptions
 from google.cloud import storage
 
 
+# direct upload filename schema, as opposed to a web upload:
+# directupload_modelname_modelversion_ppfunc_cuts_etc
+# special "benchmark" direct uploads include "benchmarkingNspecial" in etc.
+DIRECT_UPLOAD_PATTERN = re.compile(
+    r'uploads(?:/|%2F)'
+    r'(?P<filename>directupload_'
+    r'(?P<model_name>[^_]+)_(?P<model_version>[0-9]+)_'
+    r'(?P<postprocess_function>[^_]+)_(?P<cuts>[0-9]+)_'
+    r'(?=(?:.*?benchmarking(?P<benchmark>[0-9]+)special)?).+)$')
+
+
 class BaseBucketMonitor(object):  # pylint: disable=useless-object-inheritance
     """Base BucketMonitor class.
 
@@ -47,6 +58,10 @@ class BaseBucketMonitor(object):  # pylint: disable=useless-object-inheritance
         bucket (str): The name of the stoage bucket.
     """
 
+    # storage client shared by every monitor, created on first use
+    _storage_client = None
+    _storage_client_lock = threading.Lock()
+
     def __init__(self, bucket):
         try:
             protocol, bucket_name = str(bucket).lower().split('://', 1)
@@ -57,22 +72,40 @@ class BaseBucketMonitor(object):  # pylint: disable=useless-object-inheritance
         self.cloud_provider = protocol
         self.bucket_name = bucket_name
         self.logger = logging.getLogger(str(self.__class__.__name__))
+        self._bucket = None
 
     def get_storage_api(self):
         if self.cloud_provider == 'gs':
-            return storage.Client()
+            # reuse the client and its authorized HTTP session across scans
+            # and across monitors, so they all share its connection pool.
+            with BaseBucketMonitor._storage_client_lock:
+                if BaseBucketMonitor._storage_client is None:
+                    BaseBucketMonitor._storage_client = storage.Client()
+            return BaseBucketMonitor._storage_client
         if self.cloud_provider == 's3':
             raise NotImplementedError('{} does not yet support `{}`.'.format(
                 self.__class__.__name__, self.cloud_provider))
         raise ValueError('Invalid value for `cloud_provider`: {}.'.format(
             self.cloud_provider))
 
+    def get_bucket(self):
+        if self._bucket is None:
+            # client.bucket() only builds a reference to the bucket, while
+            # client.get_bucket() would also request its metadata.
+            self._bucket = self.get_storage_api().bucket(self.bucket_name)
+        return self._bucket
+
     def get_all_files(self, prefix=None):
         all_uploads = []
         if self.cloud_provider == 'gs':
-            client = self.get_storage_api()
-            bucket = client.get_bucket(self.bucket_name)
-            all_uploads = bucket.list_blobs(prefix=prefix)
+            bucket = self.get_bucket()
+            # only request the metadata the monitors read, a blob's path
+            # and public_url are both derived from its name client-side.
+            # generation makes delete() target the listed version of a file
+            # and lets the client retry the delete on transient errors.
+            all_uploads = bucket.list_blobs(
+                prefix=prefix,
+                fields='items(name,updated,generation),nextPageToken')
         elif self.cloud_provider == 's3':
             raise NotImplementedError('{} does not yet support `{}`.'.format(
                 self.__class__.__name__, self.cloud_provider))
@@ -86,122 +119,247 @@ class BucketMonitor(BaseBucketMonitor):
         redis_client (obj): Redis client object for communicating with redis.
         bucket_name (str): The name of the stoage bucket.
         queue (str): The redis queue name to add new jobs.
+        seen_filenames (str): The prefix of the redis keys marking
+            already processed filenames. Defaults to one per bucket.
+        cursor (str): The redis key storing the baseline of the last scan.
+            Defaults to one per bucket.
+        seen_ttl (int): How long a processed filename is remembered,
+            in seconds. Re-uploads of the filename are ignored until then.
     """
 
-    def __init__(self, redis_client, bucket, queue):
-        self.redis_client = redis_client
-        self.queue = str(queue).lower()
+    def __init__(self, redis_client, bucket, queue,
+                 seen_filenames=None,
+                 cursor=None,
+                 seen_ttl=7 * 24 * 60 * 60):
+        super(BucketMonitor, self).__init__(bucket)
 
-        # get initial timestamp to act as a baseline, assume UTC for everything
-        self.current_timestamp = datetime.datetime.now(pytz.UTC)
+        # monitors of different buckets must not share state in redis
+        if seen_filenames is None:
+            seen_filenames = 'bucket_monitor:seen:{}'.format(self.bucket_name)
+        if cursor is None:
+            cursor = 'bucket_monitor:cursor:{}'.format(self.bucket_name)
 
-        super(BucketMonitor, self).__init__(bucket)
+        self.redis_client = redis_client
+        self.queue = str(queue).lower()
+        self.seen_filenames = str(seen_filenames)
+        self.cursor = str(cursor)
+        self.seen_ttl = int(seen_ttl)
+        self.hostname = os.getenv('HOSTNAME', '')
+
+        # resume from the last scan's baseline so uploads that arrived while
+        # the monitor was down are not skipped, assume UTC for everything
+        last_timestamp = self.redis_client.get(self.cursor)
+        if last_timestamp is not None:
+            self.current_timestamp = datetime.datetime.fromtimestamp(
+                float(last_timestamp), datetime.timezone.utc)
+        else:
+            # get initial timestamp to act as a baseline
+            self.current_timestamp = datetime.datetime.now(
+                datetime.timezone.utc)
 
     def scan_bucket_for_new_uploads(self, prefix='uploads/'):
         # get a timestamp to mark the baseline for the next loop iteration
-        next_timestamp = datetime.datetime.now(pytz.UTC)
+        next_timestamp = datetime.datetime.now(datetime.timezone.utc)
         self.logger.info('New loop at %s', next_timestamp)
 
         # get references to every file starting with `prefix`
         all_uploads = self.get_all_files(prefix=prefix)
 
-        # get current redis keys to avoid double entries
-        redis_keys = '\t'.join(self.redis_client.keys())  # TODO: O(n)
-
+        new_uploads = []
         for upload in all_uploads:
             if upload.name == prefix:
                 continue  # no need to process the prefix directory
 
             # only process files uploaded between now and last iteration
             if upload.updated > self.current_timestamp:
-                self.logger.info('Found new upload: %s', upload.name)
-                # parse necessary information from the filename
-                # and write an appropriate entry to Redis
-                self.write_new_redis_key(upload, redis_keys)
+                self.logger.debug('Found new upload: %s', upload.name)
+                new_uploads.append(upload)
+
+        # skip redis entirely when the bucket is idle. The stored baseline
+        # then lags behind, and a restarted monitor lists again the uploads
+        # that arrived while the last busy scan was listing. Those are only
+        # skipped while they are still marked as seen, so they are queued
+        # again if the restart comes more than `seen_ttl` after that scan.
+        if new_uploads:
+            self.logger.info('Found %s new uploads.', len(new_uploads))
+
+            # parse necessary information from each filename and check
+            # all of them against Redis in a single round trip
+            parsed_uploads = []
+            for upload in new_uploads:
+                fields = self.parse_upload_path(upload)
+                if fields is not None:
+                    parsed_uploads.append((upload, fields))
+
+            exists = self.filenames_exist(
+                [fields['filename'] for _, fields in parsed_uploads])
+
+            # queue the writes for every new upload and send them at once.
+            # a retried batch must not have been partially applied, or its
+            # entries would be queued twice, so send it as a transaction.
+            pipeline = self.redis_client.pipeline(transaction=True)
+            for (upload, fields), upload_exists in zip(parsed_uploads, exists):
+                # write an appropriate entry to Redis
+                self.write_upload_entries(upload, fields, upload_exists,
+                                          next_timestamp, pipeline=pipeline)
+
+            # persist the new baseline along with the entries it covers
+            pipeline.set(self.cursor, next_timestamp.timestamp())
+            pipeline.execute()
 
         self.current_timestamp = next_timestamp  # update baseline timestamp
 
-    def write_new_redis_key(self, upload, redis_keys):
-        filename_pattern = '(uploads(?:/|%2F))(directupload_.+)$'
-        # verify the upload is a direct upload, and not a web upload
+    def get_seen_key(self, filename):
+        """Returns the redis key marking `filename` as processed."""
+        return '{}:{}'.format(self.seen_filenames, filename)
+
+    def filenames_exist(self, filenames):
+        """Checks all `filenames` against Redis in a single round trip."""
+        if not filenames:
+            return []
+        keys = [self.get_seen_key(filename) for filename in filenames]
+        return [value is not None for value in self.redis_client.mget(keys)]
+
+    def parse_upload_path(self, upload):
+        """Returns the parsed fields of a direct upload, or None if invalid."""
+        # verify the upload is a direct upload, and not a web upload,
+        # and parse all necessary information from its filename at once
         try:
-            re_results = re.search(filename_pattern, upload.path)
-            upload_filename = re_results.group(2)
+            return DIRECT_UPLOAD_PATTERN.search(upload.path).groupdict()
         except AttributeError as err:
             # this isn't a directly uploaded file
             # or its filename was formatted incorrectly
             self.logger.error('Failed on filename of %s. Error: %s: %s',
                               upload.name, type(err).__name__, err)
+            return None
+
+    def write_new_redis_key(self, upload, pipeline=None, timestamp=None):
+        """Parses a single upload and creates its redis entries.
+
+        Args:
+            upload: object representing item in storage bucket
+            pipeline: redis pipeline to queue the writes on. If None,
+                the writes are sent to redis immediately.
+            timestamp: datetime, creation time of the entries.
+                Defaults to now.
+
+        Returns:
+            int: the number of entries created.
+        """
+        fields = self.parse_upload_path(upload)
+        if fields is None:
             return 0
 
-        # check for presence of filename in Redis already
-        if upload_filename in redis_keys:
+        if timestamp is None:
+            timestamp = datetime.datetime.now(datetime.timezone.utc)
+
+        exists, = self.filenames_exist([fields['filename']])
+        return self.write_upload_entries(upload, fields, exists, timestamp,
+                                         pipeline=pipeline)
+
+    def write_upload_entries(self, upload, fields, exists, timestamp,
+                             pipeline=None):
+        """Creates the redis entries for an already parsed upload.
+
+        Args:
+            upload: object representing item in storage bucket
+            fields: dict, result of parse_upload_path.
+            exists: bool, whether the upload was already written to redis.
+            timestamp: datetime, creation time of the entries.
+            pipeline: redis pipeline to queue the writes on. If None,
+                the writes are sent to redis immediately.
+
+        Returns:
+            int: the number of entries created.
+        """
+        upload_filename = fields['filename']
+
+        if exists:
             self.logger.warning('%s tried to get uploaded a second time.',
                                 upload_filename)
             return 0
 
+        # all entries for this upload share the same fields and values
+        field_dict = self.get_field_dict(upload, fields, timestamp)
+
+        # mark the upload as seen once, however many entries it creates.
+        # the mark expires so a later re-upload of the file is processed.
+        redis_client = self.redis_client if pipeline is None else pipeline
+        redis_client.set(self.get_seen_key(upload_filename), 1,
+                         ex=self.seen_ttl)
+
         # is this a special "benchmark" direct upload?
-        benchmark_pattern = 'benchmarking([0-9]+)special'
-        benchmark_result = re.search(benchmark_pattern, upload_filename)
-        if benchmark_result is None:
+        if fields['benchmark'] is None:
             # standard direct upload
-            self.create_redis_entry(upload, upload_filename, upload_filename)
+            self.create_redis_entry(upload_filename, field_dict,
+                                    os.urandom(16).hex(), pipeline=pipeline)
             return 1
 
         # "benchmarking" direct upload
         base, ext = os.path.splitext(upload_filename)
-        count = int(benchmark_result.group(1))
+        count = int(fields['benchmark'])
+        # draw the random ids for every entry with a single syscall
+        unique_ids = os.urandom(16 * count).hex()
         for i in range(count):
             new_filename = '{basename}{uid}{ext}'.format(
                 basename=base, uid=i, ext=ext)
-            self.create_redis_entry(upload, new_filename, upload_filename)
+            self.create_redis_entry(new_filename, field_dict,
+                                    unique_ids[32 * i:32 * (i + 1)],
+                                    pipeline=pipeline)
         return count
 
-    def create_redis_entry(self, upload, modified_filename, original_filename):
-        """Creates a redis entry based on the `upload_filename`.
+    def get_field_dict(self, upload, fields, timestamp):
+        """Returns the fields and values of redis entries for an upload.
 
         Args:
             upload: object representing item in storage bucket
-            modified_filename: string, updated uploaded file name for benchmark
-            original_filename: string, name of original uploaded file
-            count: int, number of redis entries to create
+            fields: dict, result of parse_upload_path.
+            timestamp: datetime, creation time of the entry.
+
+        Returns:
+            dict: the entry's fields.
         """
-        # create a unique redis key
-        redis_key = '{prefix}:{unique_id}:{filename}'.format(
-            prefix='predict',
-            unique_id=uuid.uuid4().hex,
-            filename=modified_filename)
+        created_at = timestamp.isoformat(' ')
 
-        # create the new redis key's fields and values
-        field_dict = {
+        return {
             'status': 'new',
             'url': upload.public_url,
-            'input_file_name': 'uploads/%s' % original_filename,
-            'identity_upload': os.getenv('HOSTNAME', ''),
-            'created_at': datetime.datetime.now(pytz.UTC).isoformat(' '),
-            'updated_at': datetime.datetime.now(pytz.UTC).isoformat(' '),
+            'input_file_name': 'uploads/%s' % fields['filename'],
+            'identity_upload': self.hostname,
+            'created_at': created_at,
+            'updated_at': created_at,
+            'model_name': fields['model_name'],
+            'model_version': fields['model_version'],
+            'postprocess_function': fields['postprocess_function'],
+            'cuts': fields['cuts'],
         }
 
-        try:
-            # filename schema: modelname_modelversion_ppfunc_cuts_etc
-            pattern = 'directupload_([^_]+)_([0-9]+)_([^_]+)_([0-9]+)_.+$'
-            fields = re.search(pattern, original_filename)
-            field_dict.update({
-                'model_name': fields.group(1),
-                'model_version': fields.group(2),
-                'postprocess_function': fields.group(3),
-                'cuts': fields.group(4)
-            })
-        except AttributeError:
-            self.logger.error('Failed to parse fields from filename: `%s`.',
-                              original_filename)
-            return False
+    def create_redis_entry(self, filename, field_dict, unique_id,
+                           pipeline=None):
+        """Creates a redis entry and adds it to the queue.
+
+        Args:
+            filename: string, uploaded file name, updated for benchmarks
+            field_dict: dict, the entry's fields from get_field_dict.
+            unique_id: string, random hex id of the redis key.
+            pipeline: redis pipeline to queue the writes on. If None,
+                the writes are sent to redis immediately.
+
+        Returns:
+            str: the redis key of the new entry.
+        """
+        # create a unique redis key
+        redis_key = '{prefix}:{unique_id}:{filename}'.format(
+            prefix='predict',
+            unique_id=unique_id,
+            filename=filename)
 
-        self.redis_client.hmset(redis_key, field_dict)
-        self.redis_client.lpush(self.queue, redis_key)
+        redis_client = self.redis_client if pipeline is None else pipeline
+        redis_client.hset(redis_key, mapping=field_dict)
+        redis_client.lpush(self.queue, redis_key)
         self.logger.debug('Wrote Redis entry of %s for %s.',
-                          self.redis_client.hgetall(redis_key), redis_key)
-        return True
+                          field_dict, redis_key)
+        return redis_key
 
 
 class StaleFileBucketMonitor(BaseBucketMonitor):
@@ -209,28 +367,79 @@ class StaleFileBucketMonitor(BaseBucketMonitor):
 
     def scan_bucket_for_stale_files(self,
                                     prefix='uploads/',
-                                    threshold=7 * 24 * 60 * 60):
+                                    threshold=7 * 24 * 60 * 60,
+                                    batch_size=100):
         """Remove stale files in bucket with the given prefix
 
         Args:
             prefix (str): The prefix/folder to look for stale files.
             threshold (int): The maximum allowed age of files, in seconds.
+            batch_size (int): The number of files deleted per request.
         """
-        prefix = '{}/'.format(prefix) if not prefix.endswith('/') else prefix
-
-        current_timestamp = datetime.datetime.now(pytz.UTC)
+        # object names never start with '/', so strip both ends of the prefix
+        prefix = prefix.strip('/')
+        if not prefix:
+            # an empty prefix would match, and delete, every file in the bucket
+            self.logger.warning('Refusing to scan for stale files without a '
+                                'prefix, the whole bucket would be pruned.')
+            return
+        prefix = '{}/'.format(prefix)
+
+        current_timestamp = datetime.datetime.now(datetime.timezone.utc)
+        cutoff = current_timestamp - datetime.timedelta(seconds=threshold)
 
         # get references to every file starting with `prefix`
         all_files = self.get_all_files(prefix=prefix)
 
+        stale_files = []
         for f in all_files:
             if f.name == prefix:
                 continue  # no need to process the prefix directory
 
-            age_in_seconds = (current_timestamp - f.updated).total_seconds()
-
-            if age_in_seconds > threshold:
-                self.logger.info('Found file %s which is %s seconds old.',
-                                 f.name, age_in_seconds)
-                f.delete()  # delete the file, cannot be undone
+            if f.updated < cutoff:
+                self.logger.debug('Found file %s which is %s seconds old.',
+                                  f.name, (current_timestamp - f.updated)
+                                  .total_seconds())
+                stale_files.append(f)
+
+        if stale_files:
+            self.logger.info('Found %s files older than %s seconds.',
+                             len(stale_files), threshold)
+
+        # send the deletes in batches, each batch is a single HTTP request
+        for i in range(0, len(stale_files), batch_size):
+            batch = stale_files[i:i + batch_size]
+            try:
+                with self.get_storage_api().batch():
+                    for f in batch:
+                        f.delete()  # delete the file, cannot be undone
+            except exceptions.GoogleAPICallError as err:
+                # the batch only reports its first failure, so it is unknown
+                # which of its files are gone. Retry them one by one.
+                self.logger.warning('Failed to delete a batch of %s files '
+                                    'due to %s: %s. Retrying them one by one.',
+                                    len(batch), type(err).__name__, err)
+                batch = [f for f in batch if self.delete_file(f)]
+
+            for f in batch:
                 self.logger.info('Successfully deleted file %s.', f.name)
+
+    def delete_file(self, f):
+        """Deletes a single file, returns whether it is gone from the bucket.
+
+        Args:
+            f: object representing item in storage bucket
+
+        Returns:
+            bool: False if the file could not be deleted.
+        """
+        try:
+            f.delete()
+        except exceptions.NotFound:
+            pass  # already deleted by the failed batch
+        except exceptions.GoogleAPICallError as err:
+            self.logger.warning('Failed to delete file %s due to %s: %s. '
+                                'It is left for the next scan.',
+                                f.name, type(err).__name__, err)
+            return False
+        return True
@@ -28,18 +28,21 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import contextlib
 import datetime
 
 import fakeredis
-import pytz
 import pytest
 
+from google.api_core import exceptions
+
 import bucket_monitor
 
 
-class Bunch(object):
-    def __init__(self, **kwds):
-        self.__dict__.update(kwds)
+Blob = collections.namedtuple('Blob', [
+    'name', 'updated', 'delete', 'path', 'public_url'])
+Blob.__new__.__defaults__ = (None,) * len(Blob._fields)
 
 
 @pytest.fixture
@@ -47,25 +50,38 @@ def redis_client():
     yield fakeredis.FakeStrictRedis(decode_responses='utf8')
 
 
+@pytest.fixture(autouse=True)
+def reset_storage_client(mocker):
+    # the storage client is shared by all monitors, so without a reset
+    # each test would reuse the client created by an earlier test.
+    mocker.patch.object(bucket_monitor.BaseBucketMonitor,
+                        '_storage_client', None)
+
+
 class DummyBucket(object):
     def __init__(self, *_, **__):
         pass
 
-    def get_bucket(self, *_):
+    def bucket(self, *_):
         return DummyBucket()
 
-    def list_blobs(self, prefix):
-        return [
-            Bunch(name=prefix,
-                  updated=datetime.datetime.now(pytz.UTC),
-                  delete=lambda: True),
-            Bunch(name='%sfile.tiff' % prefix,
-                  updated=datetime.datetime.now(pytz.UTC),
-                  delete=lambda: True),
-            Bunch(name='%sfile.zip' % prefix,
-                  updated=datetime.datetime.now(pytz.UTC),
-                  delete=lambda: True)
+    @contextlib.contextmanager
+    def batch(self):
+        yield
+
+    def list_blobs(self, prefix, **_):
+        names = [
+            prefix,
+            '%sfile.tiff' % prefix,
+            '%sfile.zip' % prefix,
+            '%sdirectupload_model_1_argmax_0_file.tiff' % prefix,
         ]
+        return [Blob(name=name,
+                     path=name,
+                     public_url='dummy_url',
+                     updated=datetime.datetime.now(datetime.timezone.utc),
+                     delete=lambda: True)
+                for name in names]
 
 
 class TestBaseBucketMonitor(object):
@@ -76,7 +92,17 @@ class TestBaseBucketMonitor(object):
             with pytest.raises(ValueError):
                 bucket_monitor.BaseBucketMonitor(bucket=bad_bucket)
 
-    def test_get_storage_api(self):
+    def test_get_storage_api(self, mocker):
+        # test GKE client is created once and shared by all monitors
+        mocker.patch('google.cloud.storage.Client', DummyBucket)
+        monitor = bucket_monitor.BaseBucketMonitor(bucket='gs://bucket')
+        client = monitor.get_storage_api()
+        assert isinstance(client, DummyBucket)
+        assert monitor.get_storage_api() is client
+        other = bucket_monitor.StaleFileBucketMonitor(bucket='gs://other')
+        assert other.get_storage_api() is client
+        assert monitor.get_bucket() is monitor.get_bucket()
+
         # test AWS not implemented yet
         monitor = bucket_monitor.BaseBucketMonitor(bucket='s3://bucket')
         with pytest.raises(NotImplementedError):
@@ -92,12 +118,16 @@ class TestBaseBucketMonitor(object):
         mocker.patch('google.cloud.storage.Client', DummyBucket)
         monitor = bucket_monitor.BaseBucketMonitor(bucket='gs://bucket')
         prefix = 'test/'
+        spy = mocker.spy(DummyBucket, 'list_blobs')
         uploads = monitor.get_all_files(prefix)
 
         get_names = lambda x: [u.name for u in x]  # pylint: disable=E1101
         names = get_names(uploads)
         assert names == get_names(DummyBucket().list_blobs(prefix))
 
+        # deletes need the generation of the listed files
+        assert 'generation' in spy.call_args_list[0][1]['fields']
+
         # test invalid values for cloud_provider
         monitor = bucket_monitor.BaseBucketMonitor(bucket='bad://bucket')
         uploads = monitor.get_all_files('prefix/')
@@ -113,27 +143,100 @@ class TestBucketMonitor(object):
             redis_client=redis_client,
             bucket='gs://bucket',
             queue='q')
+
+        # an idle bucket does not touch redis
+        spy = mocker.spy(redis_client, 'pipeline')
+        mocker.patch.object(monitor, 'get_all_files', lambda **_: [])
         monitor.scan_bucket_for_new_uploads(prefix='uploads/')
+        spy.assert_not_called()
+        assert redis_client.get(monitor.cursor) is None
+
+        mocker.patch.object(monitor, 'get_all_files',
+                            DummyBucket().list_blobs)
+        monitor.scan_bucket_for_new_uploads(prefix='uploads/')
+        # only the direct upload is written to redis
+        assert redis_client.llen('q') == 1
+        # in a single transaction, so a retry cannot queue it twice
+        spy.assert_called_once_with(transaction=True)
+
+        # uploads are only processed once
+        monitor.scan_bucket_for_new_uploads(prefix='uploads/')
+        assert redis_client.llen('q') == 1
+
+        # a new monitor resumes from the last scan's baseline
+        restarted = bucket_monitor.BucketMonitor(
+            redis_client=redis_client,
+            bucket='gs://bucket',
+            queue='q')
+        assert restarted.current_timestamp == monitor.current_timestamp
 
-    def test_write_new_redis_key(self, redis_client):
-        redis_keys = 'uploads/directupload_previously_uploaded.tifothertext'
+        # monitors of other buckets keep their own baseline and seen keys
+        other = bucket_monitor.BucketMonitor(
+            redis_client=redis_client,
+            bucket='gs://other',
+            queue='q')
+        assert other.cursor != monitor.cursor
+        assert other.seen_filenames != monitor.seen_filenames
+        assert other.current_timestamp > monitor.current_timestamp
+
+    def test_filenames_exist(self, redis_client):
+        monitor = bucket_monitor.BucketMonitor(
+            redis_client=redis_client,
+            bucket='gs://bucket',
+            queue='q')
+        redis_client.set(monitor.get_seen_key('seen.tiff'), 1)
+
+        assert monitor.filenames_exist([]) == []
+        assert monitor.filenames_exist(['new.tiff', 'seen.tiff']) == [
+            False, True]
+
+    def test_parse_upload_path(self, redis_client):
         monitor = bucket_monitor.BucketMonitor(
             redis_client=redis_client,
             bucket='gs://bucket',
             queue='q')
 
+        fname = 'directupload_model_1_argmax_0_benchmarking4special_file.tiff'
+        for path in ('uploads/%s' % fname, 'uploads%%2F%s' % fname):
+            fields = monitor.parse_upload_path(Blob(path=path, name=path))
+            assert fields['filename'] == fname
+            assert fields['model_name'] == 'model'
+            assert fields['benchmark'] == '4'
+
         # test invalid web upload
-        invalid_file = Bunch(path='uploads/web.tiff',
-                             name='uploads/web.tiff',
-                             public_url='dummy_url')
-        result = monitor.write_new_redis_key(invalid_file, redis_keys)
+        upload = Blob(path='uploads/web.tiff', name='uploads/web.tiff')
+        assert monitor.parse_upload_path(upload) is None
+
+        # test direct upload outside of the uploads folder
+        upload = Blob(path=fname, name=fname)
+        assert monitor.parse_upload_path(upload) is None
+
+    def test_write_new_redis_key(self, mocker, redis_client):
+        monitor = bucket_monitor.BucketMonitor(
+            redis_client=redis_client,
+            bucket='gs://bucket',
+            queue='q')
+        redis_client.set(monitor.get_seen_key(
+            'directupload_model_1_argmax_0_previous.tif'), 1)
+
+        # test invalid web upload
+        invalid_file = Blob(path='uploads/web.tiff',
+                            name='uploads/web.tiff',
+                            public_url='dummy_url')
+        result = monitor.write_new_redis_key(invalid_file)
+        assert result == 0
+
+        # test direct upload with a badly formatted filename
+        invalid_file = Blob(path='uploads/directupload_bad.tiff',
+                            name='uploads/directupload_bad.tiff',
+                            public_url='dummy_url')
+        result = monitor.write_new_redis_key(invalid_file)
         assert result == 0
 
         # test file that has a redis_key
-        upload = Bunch(path='uploads/directupload_previously_uploaded.tif',
-                       name='uploads/directupload_previously_uploaded.tif',
-                       public_url='dummy_url')
-        result = monitor.write_new_redis_key(upload, redis_keys)
+        fname = 'uploads/directupload_model_1_argmax_0_previous.tif'
+        upload = Blob(path=fname, name=fname, public_url='dummy_url')
+        result = monitor.write_new_redis_key(upload)
         assert result == 0
 
         # test valid direct_upload file_name
@@ -145,52 +248,74 @@ class TestBucketMonitor(object):
         fname = 'uploads/directupload_{}_{}_{}_{}_filename.tiff'.format(
             model_name, model_version, postprocess, cuts)
 
-        upload = Bunch(path=fname, name=fname, public_url=fname)
-        result = monitor.write_new_redis_key(upload, redis_keys)
+        upload = Blob(path=fname, name=fname, public_url=fname)
+        result = monitor.write_new_redis_key(upload)
         assert result == 1
 
+        # the upload is only remembered for seen_ttl seconds
+        ttl = redis_client.ttl(monitor.get_seen_key(fname.split('/')[-1]))
+        assert 0 < ttl <= monitor.seen_ttl
+
+        # test the same file is not written twice
+        result = monitor.write_new_redis_key(upload)
+        assert result == 0
+
         fname = 'uploads/directupload_{}_{}_{}_{}_{}_filename.tiff'.format(
             model_name, model_version, postprocess, cuts,
             'benchmarking4special')
-        upload = Bunch(path=fname, name=fname, public_url=fname)
-        result = monitor.write_new_redis_key(upload, redis_keys)
+        upload = Blob(path=fname, name=fname, public_url=fname)
+        spy = mocker.spy(redis_client, 'set')
+        result = monitor.write_new_redis_key(upload)
         assert result == 4
 
-    def test_create_redis_entry(self, mocker, redis_client):
-        mocker.patch('google.cloud.storage.Client', DummyBucket)
-        queue = 'q'
+        # but the benchmark upload is only marked as seen once
+        spy.assert_called_once()
+
+        # each benchmark entry gets its own random id
+        unique_ids = [k.split(':')[1] for k in redis_client.lrange('q', 0, 3)]
+        assert len(set(unique_ids)) == 4
+        assert all(len(uid) == 32 for uid in unique_ids)
+
+    def test_get_field_dict(self, redis_client):
         monitor = bucket_monitor.BucketMonitor(
             redis_client=redis_client,
             bucket='gs://bucket',
-            queue=queue)
-
-        # test valid direct_upload file_name
-        model_name = 'model'
-        model_version = 1
-        postprocess = 'argmax'
-        cuts = 0
-
-        fname = 'directupload_{}_{}_{}_{}_filename.tiff'.format(
-            model_name, model_version, postprocess, cuts)
-
-        upload = Bunch(public_url='dummy_url')
-        result = monitor.create_redis_entry(upload, fname, fname)
-        assert result is True
-        hvals = redis_client.hgetall(redis_client.lpop(queue))
-        assert hvals['model_name'] == model_name
-        assert hvals['model_version'] == str(model_version)
-        assert hvals['postprocess_function'] == postprocess
-        assert hvals['url'] == 'dummy_url'
+            queue='q')
 
-        # test bad file_name
+        fname = 'directupload_model_1_argmax_0_filename.tiff'
+        upload = Blob(path='uploads/%s' % fname, public_url='dummy_url')
+        fields = monitor.parse_upload_path(upload)
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
+        field_dict = monitor.get_field_dict(upload, fields, timestamp)
+        assert field_dict['model_name'] == 'model'
+        assert field_dict['model_version'] == '1'
+        assert field_dict['postprocess_function'] == 'argmax'
+        assert field_dict['cuts'] == '0'
+        assert field_dict['input_file_name'] == 'uploads/%s' % fname
+        assert field_dict['url'] == 'dummy_url'
+        assert field_dict['created_at'] == timestamp.isoformat(' ')
+        assert field_dict['created_at'] == field_dict['updated_at']
+
+    def test_create_redis_entry(self, redis_client):
+        queue = 'q'
         monitor = bucket_monitor.BucketMonitor(
             redis_client=redis_client,
             bucket='gs://bucket',
-            queue='q')
-        bad_fname = 'regular_filename.tiff'
-        result = monitor.create_redis_entry(upload, bad_fname, bad_fname)
-        assert result is False
-        assert redis_client.lpop(queue) is None
+            queue=queue)
+
+        field_dict = {'model_name': 'model', 'url': 'dummy_url'}
+        redis_key = monitor.create_redis_entry('file.tiff', field_dict, 'id')
+        assert redis_key == 'predict:id:file.tiff'
+        assert redis_client.lpop(queue) == redis_key
+        assert redis_client.hgetall(redis_key) == field_dict
+
+        # writes are queued on the given pipeline
+        pipeline = redis_client.pipeline()
+        redis_key = monitor.create_redis_entry('file.tiff', field_dict, 'id2',
+                                               pipeline=pipeline)
+        assert redis_client.llen(queue) == 0
+        pipeline.execute()
+        assert redis_client.lpop(queue) == redis_key
 
 
 class TestStaleFileBucketMonitor(object):
@@ -199,3 +324,59 @@ class TestStaleFileBucketMonitor(object):
         mocker.patch('google.cloud.storage.Client', DummyBucket)
         monitor = bucket_monitor.StaleFileBucketMonitor(bucket='gs://bucket')
         monitor.scan_bucket_for_stale_files(prefix='uploads/', threshold=-1)
+
+        # stale files are deleted in batches
+        spy = mocker.spy(DummyBucket, 'batch')
+        monitor.scan_bucket_for_stale_files(prefix='uploads/', threshold=-1,
+                                            batch_size=2)
+        assert spy.call_count == 2
+
+        # no files are old enough to be deleted
+        spy.reset_mock()
+        monitor.scan_bucket_for_stale_files(prefix='uploads/', threshold=60)
+        spy.assert_not_called()
+
+        # the prefix is normalized to a single trailing slash
+        spy = mocker.spy(monitor, 'get_all_files')
+        for prefix in ('//uploads', 'uploads', '/uploads/', 'uploads/'):
+            monitor.scan_bucket_for_stale_files(prefix=prefix, threshold=60)
+            spy.assert_called_with(prefix='uploads/')
+
+        # an empty prefix never lists, or prunes, the whole bucket
+        spy.reset_mock()
+        for prefix in ('', '/', '//'):
+            monitor.scan_bucket_for_stale_files(prefix=prefix, threshold=-1)
+        spy.assert_not_called()
+
+    def test_scan_bucket_for_stale_files_batch_error(self, mocker):
+        mocker.patch('google.cloud.storage.Client', DummyBucket)
+
+        @contextlib.contextmanager
+        def failed_batch(*_):
+            yield
+            raise exceptions.TooManyRequests('thrown on purpose')
+
+        mocker.patch.object(DummyBucket, 'batch', failed_batch)
+
+        # a failed batch retries its files one by one, a file it did delete
+        # is not found again and a file that still fails is left in place
+        now = datetime.datetime.now(datetime.timezone.utc)
+        not_found = exceptions.NotFound('gone')
+        too_many = exceptions.TooManyRequests('failed')
+        files = [
+            Blob(name='uploads/deleted.tiff', updated=now,
+                 delete=mocker.Mock(side_effect=[None, None])),
+            Blob(name='uploads/gone.tiff', updated=now,
+                 delete=mocker.Mock(side_effect=[None, not_found])),
+            Blob(name='uploads/failed.tiff', updated=now,
+                 delete=mocker.Mock(side_effect=[None, too_many])),
+        ]
+        monitor = bucket_monitor.StaleFileBucketMonitor(bucket='gs://bucket')
+        mocker.patch.object(monitor, 'get_all_files', lambda **_: files)
+        monitor.scan_bucket_for_stale_files(prefix='uploads/', threshold=-1)
+        assert [f.delete.call_count for f in files] == [2, 2, 2]
+
+        # only a file that still fails to delete is reported as left over
+        for f, side_effect in zip(files, [None, not_found, too_many]):
+            f.delete.side_effect = side_effect
+        assert [monitor.delete_file(f) for f in files] == [True, True, False]
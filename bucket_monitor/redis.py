@@ -121,12 +121,58 @@ REDIS_READONLY_COMMANDS = {
     'georadiusbymember',
 }
 
+# commands that can be queued on a RedisPipeline. Commands that change the
+# state of the connection itself, like WATCH or MULTI, cannot be replayed
+# on a new connection and are deliberately left out.
+REDIS_PIPELINE_COMMANDS = {
+    'decr',
+    'delete',
+    'exists',
+    'expire',
+    'get',
+    'hdel',
+    'hget',
+    'hgetall',
+    'hincrby',
+    'hmget',
+    'hmset',
+    'hset',
+    'incr',
+    'incrby',
+    'llen',
+    'lpop',
+    'lpush',
+    'lrange',
+    'lrem',
+    'mget',
+    'persist',
+    'rpop',
+    'rpush',
+    'sadd',
+    'scard',
+    'set',
+    'setex',
+    'setnx',
+    'sismember',
+    'smembers',
+    'srem',
+    'ttl',
+    'zadd',
+    'zrange',
+    'zrem',
+    'zscore',
+}
+
 
 class RedisClient(object):
 
-    def __init__(self, host, port, backoff=1):
+    # connection pools shared by every client, keyed by (host, port)
+    _connection_pools = {}
+
+    def __init__(self, host, port, backoff=1, max_backoff=30):
         self.logger = logging.getLogger(str(self.__class__.__name__))
         self.backoff = backoff
+        self.max_backoff = max_backoff
         self._sentinel = self._get_redis_client(host=host, port=port)
         self._redis_master = self._sentinel
         self._redis_slaves = [self._sentinel]
@@ -154,49 +200,155 @@ class RedisClient(object):
             self.logger.warning('Encountered Error: %s. Using sentinel as '
                                 'primary redis client.', err)
 
+    @classmethod
+    def _get_connection_pool(cls, host, port):
+        # reuse warm connections when the sentinel is re-queried after a
+        # ConnectionError, or when several clients talk to the same host.
+        key = (str(host), str(port))
+        if key not in cls._connection_pools:
+            cls._connection_pools[key] = redis.ConnectionPool(
+                host=host, port=port,
+                decode_responses=True,
+                encoding='utf-8',
+                socket_keepalive=True)
+        return cls._connection_pools[key]
+
     @classmethod
     def _get_redis_client(cls, host, port):
-        return redis.StrictRedis(host=host, port=port,
-                                 decode_responses=True,
-                                 charset='utf-8')
+        return redis.StrictRedis(
+            connection_pool=cls._get_connection_pool(host, port))
 
-    def __getattr__(self, name):
+    def _get_backoff(self, attempt):
+        """Double the backoff after each failed attempt, up to max_backoff.
 
-        def wrapper(*args, **kwargs):
-            values = list(args) + list(kwargs.values())
-            values = [str(v) for v in values]
-            while True:
-                try:
-                    if name in REDIS_READONLY_COMMANDS:
-                        redis_client = random.choice(self._redis_slaves)
-                    else:
-                        redis_client = self._redis_master
-
-                    redis_function = getattr(redis_client, name)
-                    return redis_function(*args, **kwargs)
-                except redis.exceptions.ConnectionError as err:
-                    self._update_masters_and_slaves()
+        Half of the backoff is random, so that clients which lost the same
+        connection do not all retry at the same time.
+        """
+        # cap the exponent, a float backoff overflows long before an int
+        backoff = min(self.backoff * 2 ** min(attempt, 32), self.max_backoff)
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        """Returns a pipeline that is retried as a whole on failure."""
+        return RedisPipeline(self, transaction=transaction,
+                             shard_hint=shard_hint)
+
+    def _call_with_retry(self, name, command, values):
+        """Calls `command` with a redis client until it succeeds.
+
+        Args:
+            name (str): The redis command, used to pick the client.
+            command (function): Called with the redis client to use.
+            values (list): The command's arguments, used for logging.
+        """
+        values = [str(v) for v in values]
+        attempt = 0
+        while True:
+            try:
+                if name in REDIS_READONLY_COMMANDS:
+                    redis_client = random.choice(self._redis_slaves)
+                else:
+                    redis_client = self._redis_master
+
+                return command(redis_client)
+            except redis.exceptions.ConnectionError as err:
+                self._update_masters_and_slaves()
+                backoff = self._get_backoff(attempt)
+                attempt += 1
+                self.logger.warning('Encountered %s: %s when calling '
+                                    '`%s %s`. Retrying in %s seconds.',
+                                    type(err).__name__, err,
+                                    str(name).upper(),
+                                    ' '.join(values), backoff)
+                time.sleep(backoff)
+            except redis.exceptions.ResponseError as err:
+                # check if redis just needs a backoff
+                if 'BUSY' in str(err) and 'SCRIPT KILL' in str(err):
+                    backoff = self._get_backoff(attempt)
+                    attempt += 1
                     self.logger.warning('Encountered %s: %s when calling '
                                         '`%s %s`. Retrying in %s seconds.',
                                         type(err).__name__, err,
                                         str(name).upper(),
-                                        ' '.join(values), self.backoff)
-                    time.sleep(self.backoff)
-                except redis.exceptions.ResponseError as err:
-                    # check if redis just needs a backoff
-                    if 'BUSY' in str(err) and 'SCRIPT KILL' in str(err):
-                        self.logger.warning('Encountered %s: %s when calling '
-                                            '`%s %s`. Retrying in %s seconds.',
-                                            type(err).__name__, err,
-                                            str(name).upper(),
-                                            ' '.join(values), self.backoff)
-                        time.sleep(self.backoff)
-                    else:
-                        raise err
-                except Exception as err:
-                    self.logger.error('Unexpected %s: %s when calling `%s %s`.',
-                                      type(err).__name__, err,
-                                      str(name).upper(), ' '.join(values))
+                                        ' '.join(values), backoff)
+                    time.sleep(backoff)
+                else:
                     raise err
+            except Exception as err:
+                self.logger.error('Unexpected %s: %s when calling `%s %s`.',
+                                  type(err).__name__, err,
+                                  str(name).upper(), ' '.join(values))
+                raise err
+
+    def __getattr__(self, name):
+
+        def wrapper(*args, **kwargs):
+            def command(redis_client):
+                redis_function = getattr(redis_client, name)
+                return redis_function(*args, **kwargs)
+
+            values = list(args) + list(kwargs.values())
+            return self._call_with_retry(name, command, values)
+
+        return wrapper
+
+
+class RedisPipeline(object):
+    """Buffers commands for a RedisClient and sends them in one round trip.
+
+    The buffered commands are replayed on a pipeline of the current master
+    each time ``execute`` is attempted, so the whole batch is retried with
+    the same backoff as a single command. Use ``transaction=True`` for
+    batches that must not be partially applied before they are retried.
+
+    Args:
+        client (RedisClient): The client to send the commands with.
+        transaction (bool): Whether to wrap the commands in MULTI/EXEC.
+        shard_hint (str): Passed through to the redis pipeline.
+    """
+
+    def __init__(self, client, transaction=True, shard_hint=None):
+        self.client = client
+        self.transaction = transaction
+        self.shard_hint = shard_hint
+        self.command_stack = []
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def reset(self):
+        """Discards all buffered commands."""
+        self.command_stack = []
+
+    def execute(self):
+        commands, self.command_stack = self.command_stack, []
+        if not commands:
+            return []
+
+        def command(redis_client):
+            pipeline = redis_client.pipeline(transaction=self.transaction,
+                                             shard_hint=self.shard_hint)
+            for name, args, kwargs in commands:
+                getattr(pipeline, name)(*args, **kwargs)
+            return pipeline.execute()
+
+        names = [str(name).upper() for name, _, _ in commands]
+        return self.client._call_with_retry(  # pylint: disable=W0212
+            'pipeline', command, names)
+
+    def __getattr__(self, name):
+        if name not in REDIS_PIPELINE_COMMANDS:
+            raise AttributeError('`{}` cannot be queued on a {}.'.format(
+                name, self.__class__.__name__))
+
+        def wrapper(*args, **kwargs):
+            self.command_stack.append((name, args, kwargs))
+            return self
 
         return wrapper
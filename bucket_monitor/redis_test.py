@@ -82,7 +82,7 @@ class TestRedis(object):
         key = 'job_id'
         values = {'data': str(random.randint(0, 100))}
 
-        client.hmset(key, values)  # Non-readonly
+        client.hset(key, mapping=values)  # Non-readonly
         new_values = client.hgetall(key)
 
         assert new_values == values
@@ -91,6 +91,15 @@ class TestRedis(object):
         with pytest.raises(AttributeError):
             client.unknown_function()
 
+    def test__get_redis_client(self):
+        # clients for the same host share a connection pool
+        client = RedisClient._get_redis_client('host', 6379)
+        other = RedisClient._get_redis_client('host', '6379')
+        assert client.connection_pool is other.connection_pool
+
+        other = RedisClient._get_redis_client('otherhost', 6379)
+        assert client.connection_pool is not other.connection_pool
+
     def test__update_masters_and_slaves(self, mocker):
         mocker.patch('redis.StrictRedis', WrappedFakeStrictRedis)
         client = RedisClient(host='host', port='port', backoff=0)
@@ -118,6 +127,30 @@ class TestRedis(object):
                      redis_response_error)
         client._update_masters_and_slaves()
 
+    def test__get_backoff(self, mocker):
+        mocker.patch('redis.StrictRedis', WrappedFakeStrictRedis)
+        mocker.patch('bucket_monitor.redis.RedisClient.'
+                     '_update_masters_and_slaves')
+
+        client = RedisClient(host='host', port='port',
+                             backoff=1, max_backoff=5)
+        for _ in range(10):
+            assert 0.5 <= client._get_backoff(0) <= 1
+            assert 1 <= client._get_backoff(1) <= 2
+            assert 2 <= client._get_backoff(2) <= 4
+            assert 2.5 <= client._get_backoff(3) <= 5  # capped at max_backoff
+
+        # half of the backoff is random jitter
+        mocker.patch('random.uniform', lambda a, b: b)
+        assert client._get_backoff(2) == 4
+        mocker.patch('random.uniform', lambda a, b: a)
+        assert client._get_backoff(2) == 2
+
+        # a float backoff does not overflow after many failed attempts
+        client = RedisClient(host='host', port='port',
+                             backoff=0.5, max_backoff=5)
+        assert 2.5 <= client._get_backoff(1100) <= 5
+
     def test_error_handling(self, mocker):
         mocker.patch('redis.StrictRedis',
                      lambda *_, **__: WrappedFakeStrictRedis(should_fail=True))
@@ -141,3 +174,55 @@ class TestRedis(object):
         response = client.busy_error()
         assert response
         spy.assert_called_once_with(client.backoff)
+
+    def test_pipeline(self, mocker):
+        mocker.patch('redis.StrictRedis', WrappedFakeStrictRedis)
+        mocker.patch('bucket_monitor.redis.RedisClient.'
+                     '_update_masters_and_slaves')
+
+        client = RedisClient(host='host', port='port', backoff=0)
+        key = 'job_id'
+        values = {'data': str(random.randint(0, 100))}
+
+        pipeline = client.pipeline(transaction=False)
+        pipeline.hset(key, mapping=values).lpush('queue', key)
+        assert len(pipeline) == 2
+
+        assert pipeline.execute() == [1, 1]
+        assert not pipeline  # stack is cleared after execute
+        assert pipeline.execute() == []
+        assert client.hgetall(key) == values
+
+        # the whole batch is retried after a ConnectionError
+        mocker.patch('redis.client.Pipeline.execute', side_effect=[
+            redis.exceptions.ConnectionError('thrown on purpose'),
+            [1]])
+        spy = mocker.spy(time, 'sleep')
+        pipeline.lpush('queue', key)
+        assert pipeline.execute() == [1]
+        spy.assert_called_once_with(client.backoff)
+
+    def test_pipeline_commands(self, mocker):
+        mocker.patch('redis.StrictRedis', WrappedFakeStrictRedis)
+        mocker.patch('bucket_monitor.redis.RedisClient.'
+                     '_update_masters_and_slaves')
+
+        client = RedisClient(host='host', port='port', backoff=0)
+
+        # connection state and unknown commands are not queued
+        pipeline = client.pipeline()
+        for name in ('watch', 'multi', 'unknown_function'):
+            with pytest.raises(AttributeError):
+                getattr(pipeline, name)
+        assert not pipeline
+
+        # buffered commands are discarded when leaving the context
+        with client.pipeline() as pipeline:
+            pipeline.set('key', 'value')
+            assert len(pipeline) == 1
+        assert not pipeline
+        assert client.get('key') is None
+
+        with client.pipeline() as pipeline:
+            assert pipeline.set('key', 'value').get('key').execute() == [
+                True, 'value']
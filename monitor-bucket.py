@@ -36,7 +36,6 @@ import sys
 import time
 import traceback
 import logging
-import logging.handlers
 
 import bucket_monitor
 
@@ -44,22 +43,23 @@ import bucket_monitor
 def initialize_logger(log_level='DEBUG'):
     log_level = str(log_level).upper()
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
 
     formatter = logging.Formatter('[%(levelname)s]:[%(name)s]: %(message)s')
     console = logging.StreamHandler(stream=sys.stdout)
     console.setFormatter(formatter)
 
+    # filter on the logger rather than the handler so that disabled
+    # records are dropped before they are created and formatted.
     if log_level == 'CRITICAL':
-        console.setLevel(logging.CRITICAL)
+        logger.setLevel(logging.CRITICAL)
     elif log_level == 'ERROR':
-        console.setLevel(logging.ERROR)
+        logger.setLevel(logging.ERROR)
     elif log_level == 'WARN':
-        console.setLevel(logging.WARN)
+        logger.setLevel(logging.WARN)
     elif log_level == 'INFO':
-        console.setLevel(logging.INFO)
+        logger.setLevel(logging.INFO)
     else:
-        console.setLevel(logging.DEBUG)
+        logger.setLevel(logging.DEBUG)
 
     logger.addHandler(console)
 
@@ -88,7 +88,11 @@ if __name__ == '__main__':
     MONITOR = bucket_monitor.StaleFileBucketMonitor(
         bucket=os.getenv('STORAGE_BUCKET'))
 
+    # schedule scans against a monotonic deadline so that slow scans
+    # do not push every following scan back by their own duration.
+    next_deadline = time.monotonic()
     while True:
+        next_deadline += INTERVAL
         for prefix in PREFIXES:
             try:
                 # MONITOR.scan_bucket_for_new_uploads(prefix=prefix)
@@ -98,5 +102,11 @@ if __name__ == '__main__':
                 _logger.critical('Fatal Error: %s: %s', type(err).__name__, err)
                 _logger.critical(traceback.format_exc())
                 sys.exit(1)
-        _logger.debug('Sleeping for %s seconds.', INTERVAL)
-        time.sleep(INTERVAL)
+        remaining = next_deadline - time.monotonic()
+        if remaining > 0:
+            _logger.debug('Sleeping for %s seconds.', remaining)
+            time.sleep(remaining)
+        else:
+            _logger.warning('Scan overran the %s second interval by %s '
+                            'seconds.', INTERVAL, -remaining)
+            next_deadline = time.monotonic()